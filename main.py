@@ -1,22 +1,58 @@
 from markdown_it import MarkdownIt
 import re
-import fire
+import argparse
 import glob
 import os
-from urllib.parse import urlparse, parse_qs
-from typing import List, Optional, Tuple
-from pydantic import BaseModel, Field
+from typing import TYPE_CHECKING, List, Optional, Tuple
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
 import html
 
-from anki.collection import Collection
+# anki is imported where it's used: loading it pulls in the whole Anki
+# backend, which parsing markdown doesn't need
+if TYPE_CHECKING:
+    from anki.collection import Collection
+
+# Only block-level tokens are used (the heading text is read from the inline
+# token's raw content), so the inline tokenizer, by far the most expensive
+# stage, is skipped. Built once and reused for every file.
+_MD = MarkdownIt().disable("inline")
+
+# tags (captured) and attribute blocks, stripped from heading titles in a
+# single pass
+_HEADING_STRIP_RE = re.compile(r"#([\w\d_\/]+)|\{[^}]*\}")
+_ANKI_LINK_SCHEME = "mdankibridge://"
+_ANKI_LINK_RE = re.compile(r"\[anki\]\((mdankibridge://notes/[^\s]*)\)")
+_ANKI_LINK_PARAM_RE = re.compile(r"[?&](id|mod)=([^&#]*)")
+
+
+class UnknownAnkiNoteIdError(ValueError):
+    """An anki link refers to a note that doesn't exist in the collection."""
+
+
+def load_markdown_file(filepath) -> Tuple[str, List[str]]:
+    with open(filepath, "r", encoding="utf-8") as f:
+        md_text = f.read()
+
+    # split on "\n" only (like readlines), so line indices match the line
+    # map markdown-it reports; str.splitlines would also split on \f, \x1c...
+    lines = [line + "\n" for line in md_text.split("\n")]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+
+    return md_text, lines
 
 
 def write_markdown_file(filepath, lines):
+    # one write of the whole document instead of one per line
+    md_text = "".join(lines)
     with open(filepath, "w", encoding="utf-8") as f:
-        f.writelines(lines)
+        f.write(md_text)
 
 
-class AnkiLink(BaseModel):
+@dataclass(slots=True)
+class AnkiLink:
     id: str
     mod: Optional[str] = None
 
@@ -31,27 +67,43 @@ class AnkiLink(BaseModel):
         return [f"\n[anki](mdankibridge://notes/?id={self.id}{mod_param})\n\n"]
 
 
-def normalize_lines(lines):
-    while lines and lines[0].strip() == "":
-        lines.pop(0)
-    while lines and lines[-1].strip() == "":
-        lines.pop()
+def _is_blank(line: str) -> bool:
+    """Same as line.strip() == "", without allocating the stripped copy."""
+    return not line or line.isspace()
 
-    for idx, line in enumerate(lines):
-        lines[idx] = line.rstrip("\n") + "\n"
 
-    if lines:
-        lines[-1] = lines[-1].rstrip("\n")
+def normalize_lines(lines):
+    # find the non-blank span by index, popping from the front is O(n) each
+    start, end = 0, len(lines)
+    while start < end and _is_blank(lines[start]):
+        start += 1
+    while end > start and _is_blank(lines[end - 1]):
+        end -= 1
+
+    # lines usually already end in exactly one newline, keep those as-is
+    # instead of allocating a stripped and re-terminated copy
+    normalized = [
+        (
+            line
+            if line.endswith("\n") and not line.endswith("\n\n")
+            else line.rstrip("\n") + "\n"
+        )
+        for line in lines[start:end]
+    ]
+
+    if normalized:
+        normalized[-1] = normalized[-1].rstrip("\n")
 
-    return lines
+    return normalized
 
 
-class Heading(BaseModel):
+@dataclass(slots=True)
+class Heading:
     level: int
     heading_start: int
     title_end: int
     title_text: str = ""
-    tags: List[str] = Field(default_factory=list)
+    tags: List[str] = field(default_factory=list)
     is_leaf: bool = False
     heading_body_end: Optional[int] = None
     anki_link: Optional[AnkiLink] = None
@@ -62,29 +114,46 @@ class Heading(BaseModel):
         """Generate the formatted title lines with proper heading level and tags."""
         heading_prefix = "#" * self.level + " "
 
-        # Format tags as #tag1/tag2 format
-        formatted_tags = []
-        for tag in self.tags:
-            formatted_tag = tag.replace("::", "/")
-            formatted_tags.append(f"#{formatted_tag}")
-
-        tags_text = " ".join(formatted_tags)
-
-        # Add space between title and tags if both exist
-        if self.title_text and tags_text:
-            return [f"{heading_prefix}{self.title_text} {tags_text}\n"]
-        elif self.title_text:
-            return [f"{heading_prefix}{self.title_text}\n"]
-        elif tags_text:
-            return [f"{heading_prefix}{tags_text}\n"]
-        else:
-            return [f"{heading_prefix}\n"]
+        # Title followed by tags formatted as #tag1/tag2, space-separated
+        words = [self.title_text] if self.title_text else []
+        words.extend(f"#{tag.replace('::', '/')}" for tag in self.tags)
+
+        return [heading_prefix + " ".join(words) + "\n"]
+
+
+def _extract_tags_and_strip(content: str) -> Tuple[str, List[str]]:
+    """
+    Extract tags (#tag or #tag1/tag2) from heading text and strip them,
+    together with {...} attribute blocks, in a single left-to-right pass.
+
+    Returns:
+        Tuple of the remaining text and the tags in Anki (tag1::tag2) form
+    """
+    # most headings are plain text, no need to run the regex at all
+    if "#" not in content and "{" not in content:
+        return content, []
+
+    tags = []
+    kept_parts = []
+    pos = 0
+    for match in _HEADING_STRIP_RE.finditer(content):
+        kept_parts.append(content[pos : match.start()])
+        if match.group(1):
+            tags.append(match.group(1).replace("/", "::"))
+        pos = match.end()
+    kept_parts.append(content[pos:])
+
+    return "".join(kept_parts), tags
 
 
 def parse_markdown_headings(filepath: str) -> Tuple[List[str], List[Heading]]:
     """
     Parse a markdown file and extract all headings with their properties.
 
+    The file is read on every call, but headings are cached by its content,
+    so an unchanged file isn't tokenized again. Callers get their own copies
+    and may mutate them.
+
     Args:
         filepath: Path to the markdown file
 
@@ -93,108 +162,115 @@ def parse_markdown_headings(filepath: str) -> Tuple[List[str], List[Heading]]:
         - List of lines from the markdown file
         - List of Heading objects
     """
-    # Load the markdown file
-    with open(filepath, "r", encoding="utf-8") as f:
-        lines = f.readlines()
+    md_text, lines = load_markdown_file(filepath)
+    headings = _parse_headings_cached(md_text, len(lines))
+
+    # freshly parsed headings only hold immutable values besides tags
+    return lines, [replace(heading, tags=list(heading.tags)) for heading in headings]
+
+
+def _parse_markdown_file(filepath) -> Tuple[List[str], List[Heading]]:
+    md_text, lines = load_markdown_file(filepath)
+
+    return lines, _parse_headings(md_text, len(lines))
+
+
+@lru_cache(maxsize=32)
+def _parse_headings_cached(md_text: str, line_count: int) -> List[Heading]:
+    return _parse_headings(md_text, line_count)
 
+
+def _parse_headings(md_text: str, line_count: int) -> List[Heading]:
     # Parse the markdown into tokens
-    md_text = "".join(lines)
-    md = MarkdownIt()
-    tokens = md.parse(md_text)
+    tokens = _MD.parse(md_text)
 
-    # Extract headings from tokens
+    # Extract headings from tokens, closing the previous heading (leafness
+    # and body end) as soon as the next one is seen
     headings = []
-    for i, token in enumerate(tokens):
-        if token.type == "heading_open":
-            level = int(token.tag[1])
-            inline_token = tokens[i + 1]
-            if inline_token.type == "inline":
-                content = inline_token.content
-
-                # Extract tags (#tag or #tag1/tag2)
-                tags = re.findall(r"#([\w\d_\/]+)", content)
-                tags = [tag.replace("/", "::") for tag in tags]
-
-                stripped_content = content
-                stripped_content = re.sub(r"{.*}", "", stripped_content)
-                stripped_content = re.sub(r"#([\w\d_\/]+)", "", stripped_content)
-
-                heading = Heading(
-                    level=level,
-                    heading_start=token.map[0],
-                    title_end=token.map[1],
-                    title_text=stripped_content.strip(),
-                    tags=tags,
-                )
+    heading_open_idxs = [
+        i for i, token in enumerate(tokens) if token.type == "heading_open"
+    ]
+    for i in heading_open_idxs:
+        token = tokens[i]
+        inline_token = tokens[i + 1]
+        if inline_token.type != "inline":
+            continue
 
-                headings.append(heading)
-
-    # Mark leaf headings
-    for idx, heading in enumerate(headings):
-        current_level = heading.level
-        # Assume leaf by default
-        heading.is_leaf = True
-        # Check if any subsequent heading is a child
-        for next_heading in headings[idx + 1 :]:
-            if next_heading.level > current_level:
-                # found child heading -> current not leaf
-                heading.is_leaf = False
-                break
-            elif next_heading.level <= current_level:
-                # sibling or higher-level heading encountered, move to next heading
-                break
-
-    # Find heading body ends
-    total_lines = len(lines)
-    for idx, heading in enumerate(headings):
-        # Determine end line for content
-        heading_body_end = total_lines
-        for next_heading in headings[idx + 1 :]:
-            heading_body_end = next_heading.heading_start
-            break
+        level = int(token.tag[1])
+        content = inline_token.content
+
+        stripped_content, tags = _extract_tags_and_strip(content)
 
-        heading.heading_body_end = heading_body_end
+        heading = Heading(
+            level=level,
+            heading_start=token.map[0],
+            title_end=token.map[1],
+            title_text=stripped_content.strip(),
+            tags=tags,
+        )
 
-    return lines, headings
+        if headings:
+            # only the very next heading can be a child; body runs
+            # until the next heading of any level
+            prev_heading = headings[-1]
+            prev_heading.is_leaf = level <= prev_heading.level
+            prev_heading.heading_body_end = heading.heading_start
+
+        headings.append(heading)
+
+    # Last heading is always a leaf and runs until the end of file
+    if headings:
+        headings[-1].is_leaf = True
+        headings[-1].heading_body_end = line_count
+
+    return headings
 
 
 def find_anki_link(lines) -> Optional[Tuple[int, int, AnkiLink]]:
-    anki_link_pattern = re.compile(r"\[anki\]\((mdankibridge://notes/[^\s]*)\)")
-    matches = []
+    found = None
+    last_idx = len(lines) - 1
 
     for idx, content_line in enumerate(lines):
-        match = anki_link_pattern.search(content_line)
+        # every link contains the literal scheme, a cheap substring test
+        # rules out most lines before running the regex
+        if _ANKI_LINK_SCHEME not in content_line:
+            continue
+
+        match = _ANKI_LINK_RE.search(content_line)
 
         if match:
+            # no need to scan further once a second link shows up
+            if found is not None:
+                raise ValueError("Multiple Anki links found in the same heading")
+
             if (
-                idx > 0
-                and idx < (len(lines) - 1)
-                and lines[idx - 1].strip() == ""
-                and lines[idx + 1].strip() == ""
+                0 < idx < last_idx
+                and _is_blank(lines[idx - 1])
+                and _is_blank(lines[idx + 1])
             ):
                 # if newline before and after, then link and newline after are together
-                matches.append((idx, idx + 1, match))
+                found = (idx, idx + 1, match)
             else:
-                matches.append((idx, idx, match))
+                found = (idx, idx, match)
 
-    if len(matches) > 1:
-        raise ValueError("Multiple Anki links found in the same heading")
-
-    if len(matches) == 0:
+    if found is None:
         return None
 
-    anki_url = matches[0][2].group(1)
-    parsed_url = urlparse(anki_url)
-    query_params = parse_qs(parsed_url.query)
-    id_params = query_params.get("id")
-    mod_params = query_params.get("mod")
+    link_start, link_end, match = found
+
+    anki_url = match.group(1)
+    query_params = {}
+    for key, value in _ANKI_LINK_PARAM_RE.findall(anki_url):
+        # like parse_qs: blank values are dropped, first occurrence wins
+        if value:
+            query_params.setdefault(key, value)
 
-    if not id_params or not id_params[0]:
+    if "id" not in query_params:
         raise ValueError("Anki link missing id parameter")
 
-    anki_link = AnkiLink(id=id_params[0], mod=mod_params[0] if mod_params else None)
+    anki_link = AnkiLink(id=query_params["id"], mod=query_params.get("mod"))
 
-    return matches[0][0], matches[0][1], anki_link
+    return link_start, link_end, anki_link
 
 
 def split_body(lines, headings: list[Heading]):
@@ -217,6 +293,24 @@ def split_body(lines, headings: list[Heading]):
     return headings
 
 
+def parse_and_split(filepath: str) -> Tuple[List[str], List[Heading]]:
+    """
+    Parse a markdown file and split the bodies of its leaf headings.
+
+    Args:
+        filepath: Path to the markdown file
+
+    Returns:
+        Tuple containing:
+        - List of lines from the markdown file
+        - List of leaf Heading objects with anki_link and other_content set
+    """
+    lines, headings = parse_markdown_headings(filepath)
+    leaf_headings = [heading for heading in headings if heading.is_leaf]
+
+    return lines, split_body(lines, leaf_headings)
+
+
 def find_unescape_fixed_point(text: str) -> str:
     while True:
         unescaped_text = html.unescape(text)
@@ -227,45 +321,68 @@ def find_unescape_fixed_point(text: str) -> str:
     return text
 
 
-def process_file(filepath: str, col: Collection, basic_model, deck):
-    """Process a single markdown file and sync with Anki."""
-    # print(f"Processing file: {filepath}")
-
-    lines, headings = parse_markdown_headings(filepath)
-    if not headings:
-        print(f"No headings found in {filepath}, skipping")
-        return
+def get_note_mods(col: "Collection", note_ids: List[int]) -> dict[int, int]:
+    """Read only the mods of the given notes, in one query."""
+    from anki.utils import ids2str
+
+    if not note_ids:
+        return {}
+
+    assert col.db is not None
+    rows = col.db.all(f"SELECT id, mod FROM notes WHERE id IN {ids2str(note_ids)}")
+    return {int(note_id): int(mod) for note_id, mod in rows}
+
+
+def sync_headings(
+    filepath: str,
+    col: "Collection",
+    headings: List[Heading],
+    basic_model,
+    deck,
+    verbose: bool = False,
+):
+    """Sync the leaf headings with Anki, updating them and their anki links."""
+    # check every linked note exists with one query, before anything is
+    # written to anki
+    linked_ids = [
+        int(heading.anki_link.id)
+        for heading in headings
+        if heading.is_leaf and heading.anki_link
+    ]
+    existing_ids = get_note_mods(col, linked_ids)
+    for note_id in linked_ids:
+        if note_id not in existing_ids:
+            raise UnknownAnkiNoteIdError(f"Note with id {note_id} not found in Anki")
+
+    def print_note_header(note_id):
+        if not verbose:
+            # verbose mode printed it once up front
+            print(f"Processing file: {filepath}")
+        print("Processing heading with sync_id:", note_id)
 
-    headings = split_body(lines, headings)
-
-    # lines before first heading
-    updated_lines = lines[: headings[0].heading_start]
+    # links of notes written to anki with their mod before the write (None for
+    # new notes), new mods are read back in one query once all headings are
+    # synced
+    written_links: List[Tuple[AnkiLink, Optional[int]]] = []
 
     for heading in headings:
         if not heading.is_leaf:
-            # leaving non-leaf headings completely unchanged
-            updated_lines += lines[heading.heading_start : heading.heading_body_end]
+            # non-leaf headings are not synced
             continue
 
         heading.other_content = normalize_lines(
             find_unescape_fixed_point("".join(heading.other_content)).split("\n")
         )
+        body = "".join(heading.other_content)
 
         if heading.anki_link:
-            # print("Processing heading with sync_id:", heading.anki_link.id)
             # TODO: what if note on anki-side is not BasicMarkdown - how to change?
             # TODO: looks like anki autoescapes `$` into `\$`
 
-            try:
-                note = col.get_note(int(heading.anki_link.id))
-            except Exception:
-                raise ValueError(
-                    f"Note with id {heading.anki_link.id} not found in Anki"
-                )
+            note = col.get_note(int(heading.anki_link.id))
 
             if heading.anki_link.mod and note.mod > int(heading.anki_link.mod):
-                print(f"Processing file: {filepath}")
-                print("Processing heading with sync_id:", heading.anki_link.id)
+                print_note_header(heading.anki_link.id)
                 print("    Note is newer in anki, syncing md <- anki")
 
                 # this will run even if anki has only done escaping, which
@@ -285,11 +402,9 @@ def process_file(filepath: str, col: Collection, basic_model, deck):
                     note.fields[0] = heading.title_text
                     is_diff = True
 
-                escaped_content = html.escape(
-                    "".join(heading.other_content), quote=False
-                )
+                escaped_content = html.escape(body, quote=False)
                 if escaped_content != note.fields[1]:
-                    note.fields[1] = "".join(heading.other_content)
+                    note.fields[1] = body
                     is_diff = True
 
                 if set(heading.tags) != set(note.tags):
@@ -297,57 +412,111 @@ def process_file(filepath: str, col: Collection, basic_model, deck):
                     is_diff = True
 
                 if is_diff:
+                    # reported once the new mod is known: the comparison
+                    # above sees a difference for bodies with &, < or >, even
+                    # when anki ends up storing the same content
                     col.update_note(note)
+                    written_links.append((heading.anki_link, note.mod))
+                else:
+                    if verbose:
+                        print_note_header(heading.anki_link.id)
+                        print("    Note is unchanged")
 
-                    if heading.anki_link.mod and str(note.mod) == heading.anki_link.mod:
-                        pass
-                        # print("    Note is unchanged")
-                    else:
-                        print(f"Processing file: {filepath}")
-                        print("Processing heading with sync_id:", heading.anki_link.id)
-                        if not heading.anki_link.mod:
-                            print("    Note has no mod, syncing anyway")
-                        print("    Syncing md -> anki")
-
-                # re-read note to get updated mod
-                # anki updates mod iff content has changed
-                # (i.e. we can resync same content and anki doesn't advance mod)
-                # also will get mod if we don't have mod on md side
-                note = col.get_note(int(heading.anki_link.id))
-
-                heading.anki_link.mod = str(note.mod)
+                    # nothing was written, so the mod loaded with the note is
+                    # current; also fills in mod if md side doesn't have it
+                    heading.anki_link.mod = str(note.mod)
 
         else:
             note = col.new_note(basic_model)
             note.fields[0] = heading.title_text
-            note.fields[1] = "".join(heading.other_content)
+            note.fields[1] = body
             note.tags = heading.tags
             col.add_note(note, deck["id"])
 
             anki_link = AnkiLink(id=str(note.id))
             heading.anki_link = anki_link
-            print(f"Processing file: {filepath}")
+            if not verbose:
+                print(f"Processing file: {filepath}")
             print("    Syncing new heading with sync_id:", heading.anki_link.id)
             print("    Syncing md -> anki")
 
-            note = col.get_note(int(heading.anki_link.id))
-            heading.anki_link.mod = str(note.mod)
+            written_links.append((heading.anki_link, None))
+
+    # re-read mods, update_note/add_note don't refresh them on the note object
+    # anki updates mod iff content has changed
+    # (i.e. we can resync same content and anki doesn't advance mod)
+    note_mods = get_note_mods(col, [int(link.id) for link, _ in written_links])
+    for anki_link, old_mod in written_links:
+        new_mod = note_mods[int(anki_link.id)]
+
+        if old_mod is not None:
+            if new_mod != old_mod:
+                print_note_header(anki_link.id)
+                if not anki_link.mod:
+                    print("    Note has no mod, syncing anyway")
+                print("    Syncing md -> anki")
+            elif verbose:
+                print_note_header(anki_link.id)
+                print("    Note is unchanged")
+
+        anki_link.mod = str(new_mod)
 
-        updated_lines += (
-            heading.title_lines
-            + heading.anki_link.lines
-            + heading.other_content
-            + ["\n", "\n"]  # trailing newline before next heading
-        )
+
+def process_file(
+    filepath: str, col: "Collection", basic_model, deck, verbose: bool = False
+):
+    """Process a single markdown file and sync with Anki."""
+    if verbose:
+        print(f"Processing file: {filepath}")
+
+    # the cache would only ever miss here, each file is parsed once per sync
+    lines, headings = _parse_markdown_file(filepath)
+    if not headings:
+        print(f"No headings found in {filepath}, skipping")
+        return
+
+    headings = split_body(lines, headings)
+
+    # one transaction per file: a single commit for all its notes, rolled
+    # back if the file fails to sync part-way. The markdown is only rewritten
+    # once the commit went through, so it never links to rolled back notes.
+    assert col.db is not None
+    col.db.transact(
+        lambda: sync_headings(filepath, col, headings, basic_model, deck, verbose)
+    )
+
+    # lines before first heading
+    updated_lines = lines[: headings[0].heading_start]
+
+    for heading in headings:
+        if not heading.is_leaf:
+            # leaving non-leaf headings completely unchanged
+            updated_lines.extend(
+                lines[heading.heading_start : heading.heading_body_end]
+            )
+            continue
+
+        # extend piece by piece rather than building a temporary
+        # concatenated list per heading
+        updated_lines.extend(heading.title_lines)
+        updated_lines.extend(heading.anki_link.lines)
+        updated_lines.extend(heading.other_content)
+        updated_lines.extend(["\n", "\n"])  # trailing newline before next heading
 
     # strip trailing empty lines from very end of file
-    while updated_lines and updated_lines[-1].strip() == "":
+    while updated_lines and _is_blank(updated_lines[-1]):
         updated_lines.pop()
 
     write_markdown_file(filepath, updated_lines)
 
 
-def main(filepath: str, colpath: str, modelname: str, deckname: str):
+def main(
+    filepath: str,
+    colpath: str,
+    modelname: str,
+    deckname: str,
+    verbose: bool = False,
+):
     """
     Process markdown files and sync with Anki.
 
@@ -356,7 +525,10 @@ def main(filepath: str, colpath: str, modelname: str, deckname: str):
         colpath: Path to Anki collection
         modelname: Name of the Anki note model to use
         deckname: Name of the Anki deck to use
+        verbose: Also report files and notes that needed no sync
     """
+    from anki.collection import Collection
+
     col = Collection(colpath)
 
     basic_model = col.models.by_name(modelname)
@@ -374,17 +546,37 @@ def main(filepath: str, colpath: str, modelname: str, deckname: str):
         print(f"Found {len(filepaths)} files matching pattern: {filepath}")
         for file_path in filepaths:
             if os.path.isfile(file_path):
-                process_file(file_path, col, basic_model, deck)
+                process_file(file_path, col, basic_model, deck, verbose)
     else:
         # Single file
         if not os.path.isfile(filepath):
             print(f"File not found: {filepath}")
             col.close()
             return
-        process_file(filepath, col, basic_model, deck)
+        process_file(filepath, col, basic_model, deck, verbose)
 
     col.close()
 
 
 if __name__ == "__main__":
-    fire.Fire(main)
+    parser = argparse.ArgumentParser(
+        description="Sync between Anki and Markdown files and directories"
+    )
+    parser.add_argument(
+        "--filepath",
+        required=True,
+        help='Path to markdown file(s), glob patterns like "notes/*.md" allowed',
+    )
+    parser.add_argument("--colpath", required=True, help="Path to Anki collection")
+    parser.add_argument(
+        "--modelname", required=True, help="Name of the Anki note model to use"
+    )
+    parser.add_argument(
+        "--deckname", required=True, help="Name of the Anki deck to use"
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Also report files and notes that needed no sync",
+    )
+    main(**vars(parser.parse_args()))
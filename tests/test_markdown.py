@@ -4,6 +4,7 @@ from main import (
     split_body,
     Heading,
 )
+import os
 import pathlib
 
 current_dir = pathlib.Path(__file__).parent
@@ -93,3 +94,50 @@ def test_heading_ankilink_multiple(markdown_1_lines, markdown_1_headings):
 
     with pytest.raises(Exception):
         leaf_headings = split_body(markdown_1_lines, leaf_headings[4:5])
+
+
+def test_heading_strips_each_attribute_block(tmp_path):
+    md_path = tmp_path / "attrs.md"
+    md_path.write_text("## first {.a} second {.b} #tag_a\n\nbody\n", encoding="utf-8")
+
+    _, headings = parse_markdown_headings(md_path)
+
+    assert headings[0].title_text == "first  second"
+    assert headings[0].tags == ["tag_a"]
+
+
+def test_heading_attribute_block_is_not_a_tag(tmp_path):
+    md_path = tmp_path / "attrs.md"
+    md_path.write_text("## title {#custom-id} #tag_a\n\nbody\n", encoding="utf-8")
+
+    _, headings = parse_markdown_headings(md_path)
+
+    assert headings[0].title_text == "title"
+    assert headings[0].tags == ["tag_a"]
+
+
+def test_parse_result_is_not_shared(markdown_1_data):
+    lines, headings = markdown_1_data
+    lines.append("extra\n")
+    headings[1].title_text = "changed"
+    headings[1].tags.append("extra_tag")
+
+    lines_again, headings_again = parse_markdown_headings(current_dir / "assets/1.md")
+
+    assert lines_again[-1] != "extra\n"
+    assert headings_again[1].title_text == "non-leaf heading 1"
+    assert headings_again[1].tags == ["tag_a::tag_b", "tag_c"]
+
+
+def test_parse_sees_edit_with_same_size_and_mtime(tmp_path):
+    md_path = tmp_path / "edited.md"
+    md_path.write_text("## first title\n\nbody\n")
+    parse_markdown_headings(md_path)
+
+    stat = os.stat(md_path)
+    md_path.write_text("## other title\n\nbody\n")
+    os.utime(md_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    _, headings = parse_markdown_headings(md_path)
+
+    assert headings[0].title_text == "other title"
@@ -1,11 +1,14 @@
 import pytest
+import os
 import pathlib
 import shutil
 from anki.collection import Collection
+import main as main_module
 from main import main
 from main import (
-    parse_markdown_headings,
-    split_body,
+    UnknownAnkiNoteIdError,
+    load_markdown_file,
+    parse_and_split,
 )
 
 current_dir = pathlib.Path(__file__).parent
@@ -26,6 +29,34 @@ def history_0_collection_path(tmp_path):
     collection_path.unlink()
 
 
+@pytest.fixture
+def configured_collection(history_0_collection_path):
+    """
+    Open the test collection with the starter model and deck selected.
+
+    Returns a function rather than an open collection, as main() needs the
+    collection to itself while it runs. Collections opened through it are
+    closed at teardown.
+    """
+    cols = []
+
+    def open_collection():
+        col = Collection(str(history_0_collection_path))
+
+        basic_model = col.models.by_name(starter_model)
+        deck = col.decks.by_name(starter_deck)
+        col.decks.select(deck["id"])
+        col.decks.current()["mid"] = basic_model["id"]
+
+        cols.append(col)
+        return col
+
+    yield open_collection
+
+    for col in cols:
+        col.close()
+
+
 @pytest.fixture
 def md_1_path(tmp_path):
     md_1 = current_dir / "assets/history_1.md"
@@ -86,14 +117,8 @@ def md_4_path(tmp_path):
     md_path.unlink()
 
 
-def test_starter_has_note(history_0_collection_path):
-    colpath = str(history_0_collection_path)
-    col = Collection(colpath)
-
-    basic_model = col.models.by_name(starter_model)
-    deck = col.decks.by_name(starter_deck)
-    col.decks.select(deck["id"])
-    col.decks.current()["mid"] = basic_model["id"]
+def test_starter_has_note(configured_collection):
+    col = configured_collection()
 
     note = col.get_note(starter_note_id)
 
@@ -101,24 +126,20 @@ def test_starter_has_note(history_0_collection_path):
     assert note.fields[0] == "front"
     assert note.fields[1] == "back"
 
-    col.close()
-
 
-def test_new_sync(history_0_collection_path, md_1_path):
+def test_new_sync(history_0_collection_path, configured_collection, md_1_path):
     colpath = str(history_0_collection_path)
     mdpath = str(md_1_path)
 
-    mdlines, headings = parse_markdown_headings(mdpath)
+    # only the line count is needed, no need to parse
+    _, mdlines = load_markdown_file(mdpath)
     old_lines_count = len(mdlines)
 
     main(
         filepath=mdpath, colpath=colpath, modelname=starter_model, deckname=starter_deck
     )
 
-    mdlines, headings = parse_markdown_headings(mdpath)
-    leaf_headings = [heading for heading in headings if heading.is_leaf]
-
-    leaf_headings = split_body(mdlines, leaf_headings)
+    mdlines, leaf_headings = parse_and_split(mdpath)
 
     assert (
         len(mdlines) == old_lines_count + 2
@@ -129,12 +150,7 @@ def test_new_sync(history_0_collection_path, md_1_path):
     assert leaf_headings[0].anki_link.id is not None
     assert leaf_headings[0].anki_link.mod is not None
 
-    col = Collection(colpath)
-
-    basic_model = col.models.by_name(starter_model)
-    deck = col.decks.by_name(starter_deck)
-    col.decks.select(deck["id"])
-    col.decks.current()["mid"] = basic_model["id"]
+    col = configured_collection()
 
     note = col.get_note(int(leaf_headings[0].anki_link.id))
 
@@ -144,17 +160,12 @@ def test_new_sync(history_0_collection_path, md_1_path):
         note.fields[1] == "some content"
     ), "Anki-side of the synced note does not include the link to anki."
 
-    col.close()
-
 
-def test_md2anki_update(history_0_collection_path, md_2_path):
+def test_md2anki_update(history_0_collection_path, configured_collection, md_2_path):
     colpath = str(history_0_collection_path)
     mdpath = str(md_2_path)
 
-    mdlines, headings = parse_markdown_headings(mdpath)
-    leaf_headings = [heading for heading in headings if heading.is_leaf]
-
-    leaf_headings = split_body(mdlines, leaf_headings)
+    mdlines, leaf_headings = parse_and_split(mdpath)
 
     assert mdlines[1] == "\n", "Newline before the anki-link"
     assert mdlines[3] == "\n", "Newline after the anki-link"
@@ -165,21 +176,13 @@ def test_md2anki_update(history_0_collection_path, md_2_path):
         filepath=mdpath, colpath=colpath, modelname=starter_model, deckname=starter_deck
     )
 
-    mdlines, headings = parse_markdown_headings(mdpath)
-    leaf_headings = [heading for heading in headings if heading.is_leaf]
-
-    leaf_headings = split_body(mdlines, leaf_headings)
+    mdlines, leaf_headings = parse_and_split(mdpath)
 
     assert mdlines[1] == "\n", "Newline before the anki-link"
     assert mdlines[3] == "\n", "Newline after the anki-link"
     assert leaf_headings[0].anki_link.mod > old_md_mod
 
-    col = Collection(colpath)
-
-    basic_model = col.models.by_name(starter_model)
-    deck = col.decks.by_name(starter_deck)
-    col.decks.select(deck["id"])
-    col.decks.current()["mid"] = basic_model["id"]
+    col = configured_collection()
 
     note = col.get_note(starter_note_id)
 
@@ -190,17 +193,39 @@ def test_md2anki_update(history_0_collection_path, md_2_path):
     ), "Anki-side of the synced note does not include the link to anki."
     assert set(note.tags) == set("tag_a::tag_b tag_c".split())
 
-    col.close()
+
+def test_sync_ignores_stale_parse(
+    history_0_collection_path, configured_collection, md_2_path
+):
+    colpath = str(history_0_collection_path)
+    mdpath = str(md_2_path)
+
+    # cache a parse, then edit the file keeping its size and mtime
+    parse_and_split(mdpath)
+    stat = os.stat(mdpath)
+    md_2_path.write_text(md_2_path.read_text().replace("some", "same"))
+    os.utime(mdpath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    main(
+        filepath=mdpath, colpath=colpath, modelname=starter_model, deckname=starter_deck
+    )
+
+    mdlines, leaf_headings = parse_and_split(mdpath)
+
+    assert leaf_headings[0].other_content == ["same content"]
+
+    col = configured_collection()
+
+    note = col.get_note(starter_note_id)
+
+    assert note.fields[1] == "same content"
 
 
-def test_anki2md_update(history_0_collection_path, md_3_path):
+def test_anki2md_update(history_0_collection_path, configured_collection, md_3_path):
     colpath = str(history_0_collection_path)
     mdpath = str(md_3_path)
 
-    mdlines, headings = parse_markdown_headings(mdpath)
-    leaf_headings = [heading for heading in headings if heading.is_leaf]
-
-    leaf_headings = split_body(mdlines, leaf_headings)
+    mdlines, leaf_headings = parse_and_split(mdpath)
 
     assert mdlines[1] == "\n", "Newline before the anki-link"
     assert mdlines[3] == "\n", "Newline after the anki-link"
@@ -211,12 +236,7 @@ def test_anki2md_update(history_0_collection_path, md_3_path):
         filepath=mdpath, colpath=colpath, modelname=starter_model, deckname=starter_deck
     )
 
-    col = Collection(colpath)
-
-    basic_model = col.models.by_name(starter_model)
-    deck = col.decks.by_name(starter_deck)
-    col.decks.select(deck["id"])
-    col.decks.current()["mid"] = basic_model["id"]
+    col = configured_collection()
 
     note = col.get_note(starter_note_id)
 
@@ -225,12 +245,7 @@ def test_anki2md_update(history_0_collection_path, md_3_path):
     assert note.fields[1] == "back"
     assert set(note.tags) == set()
 
-    col.close()
-
-    mdlines, headings = parse_markdown_headings(mdpath)
-    leaf_headings = [heading for heading in headings if heading.is_leaf]
-
-    leaf_headings = split_body(mdlines, leaf_headings)
+    mdlines, leaf_headings = parse_and_split(mdpath)
 
     assert mdlines[1] == "\n", "Newline before the anki-link"
     assert mdlines[3] == "\n", "Newline after the anki-link"
@@ -244,15 +259,13 @@ def test_md_unknown_id(history_0_collection_path, md_4_path):
     colpath = str(history_0_collection_path)
     mdpath = str(md_4_path)
 
-    mdlines, headings = parse_markdown_headings(mdpath)
-    leaf_headings = [heading for heading in headings if heading.is_leaf]
-    leaf_headings = split_body(mdlines, leaf_headings)
+    mdlines, leaf_headings = parse_and_split(mdpath)
 
     assert leaf_headings[0].anki_link is not None
     assert leaf_headings[0].anki_link.mod is not None
     assert leaf_headings[0].anki_link.id is not None
 
-    with pytest.raises(Exception):
+    with pytest.raises(UnknownAnkiNoteIdError):
         main(
             filepath=mdpath,
             colpath=colpath,
@@ -261,14 +274,50 @@ def test_md_unknown_id(history_0_collection_path, md_4_path):
         )
 
 
-def test_entities_roundtrip(history_0_collection_path, md_2_entities_path):
+def test_interrupted_write_keeps_linked_notes(
+    history_0_collection_path, configured_collection, md_1_path, monkeypatch
+):
     colpath = str(history_0_collection_path)
-    mdpath = str(md_2_entities_path)
+    mdpath = str(md_1_path)
 
-    mdlines, headings = parse_markdown_headings(mdpath)
-    leaf_headings = [heading for heading in headings if heading.is_leaf]
+    write_markdown_file = main_module.write_markdown_file
 
-    leaf_headings = split_body(mdlines, leaf_headings)
+    def interrupted_write_markdown_file(filepath, lines):
+        write_markdown_file(filepath, lines)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(
+        main_module, "write_markdown_file", interrupted_write_markdown_file
+    )
+
+    with pytest.raises(KeyboardInterrupt):
+        main(
+            filepath=mdpath,
+            colpath=colpath,
+            modelname=starter_model,
+            deckname=starter_deck,
+        )
+
+    mdlines, leaf_headings = parse_and_split(mdpath)
+
+    assert leaf_headings[0].anki_link is not None
+
+    col = configured_collection()
+
+    note = col.get_note(int(leaf_headings[0].anki_link.id))
+
+    assert (
+        note.fields[0] == "heading title"
+    ), "Notes are committed before the markdown links to them."
+
+
+def test_entities_roundtrip(
+    history_0_collection_path, configured_collection, md_2_entities_path
+):
+    colpath = str(history_0_collection_path)
+    mdpath = str(md_2_entities_path)
+
+    mdlines, leaf_headings = parse_and_split(mdpath)
 
     assert mdlines[1] == "\n", "Newline before the anki-link"
     assert mdlines[3] == "\n", "Newline after the anki-link"
@@ -280,10 +329,7 @@ def test_entities_roundtrip(history_0_collection_path, md_2_entities_path):
         filepath=mdpath, colpath=colpath, modelname=starter_model, deckname=starter_deck
     )
 
-    mdlines, headings = parse_markdown_headings(mdpath)
-    leaf_headings = [heading for heading in headings if heading.is_leaf]
-
-    leaf_headings = split_body(mdlines, leaf_headings)
+    mdlines, leaf_headings = parse_and_split(mdpath)
 
     assert mdlines[1] == "\n", "Newline before the anki-link"
     assert mdlines[3] == "\n", "Newline after the anki-link"
@@ -295,12 +341,7 @@ def test_entities_roundtrip(history_0_collection_path, md_2_entities_path):
         filepath=mdpath, colpath=colpath, modelname=starter_model, deckname=starter_deck
     )
 
-    col = Collection(colpath)
-
-    basic_model = col.models.by_name(starter_model)
-    deck = col.decks.by_name(starter_deck)
-    col.decks.select(deck["id"])
-    col.decks.current()["mid"] = basic_model["id"]
+    col = configured_collection()
 
     note = col.get_note(starter_note_id)
 
@@ -309,12 +350,7 @@ def test_entities_roundtrip(history_0_collection_path, md_2_entities_path):
     # assert note.fields[1] == """quote:\n\n&gt; `L&amp;` "'"\n\ncontent"""
     assert note.fields[1] == """quote:\n\n> `L&` "'"\n\ncontent"""
 
-    col.close()
-
-    mdlines, headings = parse_markdown_headings(mdpath)
-    leaf_headings = [heading for heading in headings if heading.is_leaf]
-
-    leaf_headings = split_body(mdlines, leaf_headings)
+    mdlines, leaf_headings = parse_and_split(mdpath)
 
     assert mdlines[1] == "\n", "Newline before the anki-link"
     assert mdlines[3] == "\n", "Newline after the anki-link"
@@ -326,3 +362,24 @@ def test_entities_roundtrip(history_0_collection_path, md_2_entities_path):
     # HTML-special characters are replaced with test_entities
     # NOT at the time of writing to the DB, but when the note
     # gets opened in the Anki app in any context.
+
+
+def test_entities_resync_reports_no_change(
+    history_0_collection_path, md_2_entities_path, capsys
+):
+    colpath = str(history_0_collection_path)
+    mdpath = str(md_2_entities_path)
+
+    main(
+        filepath=mdpath, colpath=colpath, modelname=starter_model, deckname=starter_deck
+    )
+
+    assert "Syncing md -> anki" in capsys.readouterr().out
+
+    main(
+        filepath=mdpath, colpath=colpath, modelname=starter_model, deckname=starter_deck
+    )
+
+    assert (
+        capsys.readouterr().out == ""
+    ), "Escaped entities alone don't make a note count as synced."